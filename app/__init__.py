@@ -5,8 +5,12 @@ __service__ = os.environ.get("SERVICE_NAME", "Rocket Manager")
 __root__ = os.environ.get("ROOT_PATH", "")
 __startup_time__ = int(os.environ.get("STARTUP_TIME", "10"))
 
+# Use in-memory Redis and broker stand-ins instead of the real services
+LOCAL_BACKENDS = os.environ.get("LOCAL_BACKENDS", "0") == "1"
+
 USER_SECRET = os.environ.get("SECRET_KEY", "e9629f658c37859ab9d74680a3480b99265c7d4c89224280cb44a255c320661f")
 USER_URL = os.environ.get("USER_URL", "http://user_manager/token")
+ADMIN_USERS = [u for u in os.environ.get("ADMIN_USERS", "").split(",") if u]
 
 JAEGER_HOST = os.environ.get("JAEGER_HOST", "jaeger")
 JAEGER_PORT = os.environ.get("JAEGER_PORT", "5775")
@@ -20,3 +24,20 @@ RF_DENSITY = float(os.environ.get("RF_DENSITY", "750"))
 WALL_THICKNESS = float(os.environ.get("WALL_THICKNESS", "0.03"))
 TIME_DELTA = float(os.environ.get("TIME_DELTA", "1.0"))
 MASS_FLOW = float(os.environ.get("MASS_FLOW", "2500"))
+
+# Compute flight state on read from the launch time instead of ticking every rocket
+LAZY_FLIGHTS = os.environ.get("LAZY_FLIGHTS", "0") == "1"
+
+# Launch admission control, a limit of 0 disables it
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "0"))
+MAX_USER_IN_FLIGHT = int(os.environ.get("MAX_USER_IN_FLIGHT", "0"))
+MAX_TICK_LAG = float(os.environ.get("MAX_TICK_LAG", "0"))
+# Seconds without a finished tick before the last tick lag reading no longer counts
+TICK_LAG_WINDOW = float(os.environ.get("TICK_LAG_WINDOW", str(10 * TIME_DELTA)))
+LAUNCH_QUEUE_SIZE = int(os.environ.get("LAUNCH_QUEUE_SIZE", "0"))
+LAUNCH_RETRY_AFTER = int(os.environ.get("LAUNCH_RETRY_AFTER", "10"))
+# Seconds between sweeps releasing launch slots of flights that ended or stopped ticking
+LAUNCH_SWEEP_INTERVAL = float(os.environ.get("LAUNCH_SWEEP_INTERVAL", "60"))
+
+# Longest window the admin profiler endpoint will run for
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
@@ -0,0 +1,329 @@
+"""Load generator for soak testing a rocket manager instance
+
+Simulates a number of concurrent users, each creating, launching and watching
+their own rockets, then reports throughput, error rates, latency percentiles and
+how far behind the simulation the flights completed.
+
+    python -m app.loadgen --users 500 --rockets 2
+    python -m app.loadgen --local --users 1000  # in-memory Redis and broker
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import httpx
+import websockets
+
+from app import MAX_ENGINES, MAX_HEIGHT, MIN_ENGINES, MIN_HEIGHT, TIME_DELTA
+from app.models import Rocket
+from app.rockets import calc_flight_ticks
+from app.security import create_token
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile, 0 for an empty sequence"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[max(rank, 1) - 1]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.lags: List[float] = []
+        self.queue_waits: List[float] = []
+        self.flights = 0
+        self.queued = 0
+        self.retries = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    def record(self, op: str, latency: float, ok: bool = True):
+        self.latencies[op].append(latency)
+        if not ok:
+            self.errors[op] += 1
+
+    def summary(self) -> dict:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        requests = sum(len(v) for v in self.latencies.values())
+        ops = {}
+        for op, values in sorted(self.latencies.items()):
+            ops[op] = {
+                "count": len(values),
+                "errors": self.errors[op],
+                "error_rate": self.errors[op] / len(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": max(values),
+            }
+        return {
+            "elapsed": elapsed,
+            "requests": requests,
+            "throughput": requests / elapsed if elapsed > 0 else 0.0,
+            "operations": ops,
+            "flights": {
+                "launched": self.flights,
+                "queued": self.queued,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "completed": len(self.lags),
+                "timed_out": self.timeouts,
+                "lag_p50": percentile(self.lags, 50),
+                "lag_p90": percentile(self.lags, 90),
+                "lag_p99": percentile(self.lags, 99),
+                "lag_max": max(self.lags) if self.lags else 0.0,
+                "queue_wait_p50": percentile(self.queue_waits, 50),
+                "queue_wait_p90": percentile(self.queue_waits, 90),
+                "queue_wait_p99": percentile(self.queue_waits, 99),
+                "queue_wait_max": max(self.queue_waits) if self.queue_waits else 0.0,
+            },
+        }
+
+
+def format_summary(summary: dict) -> str:
+    lines = [
+        f"Elapsed: {summary['elapsed']:.1f}s, {summary['requests']} requests, {summary['throughput']:.1f} req/s",
+        "",
+        f"{'operation':<12}{'count':>8}{'errors':>8}{'err %':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}",
+    ]
+    for op, s in summary["operations"].items():
+        lines.append(
+            f"{op:<12}{s['count']:>8}{s['errors']:>8}{s['error_rate'] * 100:>8.1f}"
+            f"{s['p50']:>9.3f}{s['p90']:>9.3f}{s['p99']:>9.3f}{s['max']:>9.3f}"
+        )
+    f = summary["flights"]
+    lines += [
+        "",
+        f"Flights: {f['launched']} launched ({f['queued']} queued), {f['rejected']} launches rejected "
+        f"after {f['retries']} retries, {f['completed']} completed, {f['timed_out']} timed out",
+        f"Completion lag (s): p50 {f['lag_p50']:.2f}, p90 {f['lag_p90']:.2f}, p99 {f['lag_p99']:.2f}, max {f['lag_max']:.2f}",
+        f"Queue wait (s): p50 {f['queue_wait_p50']:.2f}, p90 {f['queue_wait_p90']:.2f}, "
+        f"p99 {f['queue_wait_p99']:.2f}, max {f['queue_wait_max']:.2f}",
+    ]
+    return "\n".join(lines)
+
+
+async def request(
+    client: httpx.AsyncClient, stats: Stats, op: str, method: str, path: str, accept: Sequence[int] = (), **kwargs
+) -> Optional[httpx.Response]:
+    """Timed request, returns None on errors, `accept` lists error statuses the caller handles itself"""
+    start = time.perf_counter()
+    try:
+        res = await client.request(method, path, **kwargs)
+    except httpx.HTTPError:
+        stats.record(op, time.perf_counter() - start, ok=False)
+        return None
+    ok = res.status_code < 400 or res.status_code in accept
+    stats.record(op, time.perf_counter() - start, ok=ok)
+    return res if ok else None
+
+
+def flight_timeout(rocket: Rocket, slack: float) -> float:
+    """Seconds to wait from lift off for the crash, the simulated flight time plus some slack"""
+    return calc_flight_ticks(rocket) * TIME_DELTA + slack
+
+
+async def watch_rocket(
+    ws_url: str, stats: Stats, connected: asyncio.Event, username: str, id: str, timeout: float, queue_timeout: float
+) -> Tuple[Optional[float], Optional[float]]:
+    """Wait for the rocket to crash, returns the times lift off and the crash were seen
+
+    Gives up `queue_timeout` seconds after connecting if the rocket hasn't lifted
+    off, or `timeout` seconds after lift off if it hasn't crashed.
+    """
+    start = time.perf_counter()
+    deadline = start + queue_timeout
+    lifted_off = None
+    try:
+        async with websockets.connect(ws_url) as ws:
+            stats.record("ws_connect", time.perf_counter() - start)
+            connected.set()
+            while time.perf_counter() < deadline:
+                data = json.loads(await asyncio.wait_for(ws.recv(), deadline - time.perf_counter()))
+                rocket = data["rocket"]
+                # The socket is per rocket id, make sure it's this user's rocket
+                if data["username"] != username or rocket["id"] != id:
+                    continue
+                if lifted_off is None and rocket["launched"]:
+                    lifted_off = time.perf_counter()
+                    deadline = lifted_off + timeout
+                if rocket["crashed"]:
+                    return lifted_off, time.perf_counter()
+    except asyncio.TimeoutError:
+        pass
+    except (OSError, websockets.WebSocketException):
+        stats.record("ws_connect", time.perf_counter() - start, ok=False)
+    finally:
+        connected.set()
+    return lifted_off, None
+
+
+async def poll_rockets(client: httpx.AsyncClient, stats: Stats, headers: dict, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        await request(client, stats, "poll", "GET", "/rockets", headers=headers)
+
+
+async def launch_with_retries(
+    client: httpx.AsyncClient, stats: Stats, args: argparse.Namespace, id: str, headers: dict
+) -> Optional[httpx.Response]:
+    """Back off while the service is too busy to take the launch, None if it never does"""
+    for attempt in range(args.launch_retries + 1):
+        res = await request(client, stats, "launch", "PUT", f"/rockets/{id}/launch", accept=(429,), headers=headers)
+        if res is None or res.status_code != 429:
+            return res
+        if attempt == args.launch_retries:
+            break
+        stats.retries += 1
+        await asyncio.sleep(float(res.headers.get("Retry-After", 1)))
+    stats.rejected += 1
+    return None
+
+
+async def fly_rocket(client: httpx.AsyncClient, stats: Stats, args: argparse.Namespace, username: str):
+    headers = {"Authorization": f"Bearer {create_token(username)}"}
+    body = {
+        "num_engines": random.randint(MIN_ENGINES, MAX_ENGINES),
+        "height": random.randint(MIN_HEIGHT, MAX_HEIGHT),
+    }
+    res = await request(client, stats, "create", "POST", "/rockets", json=body, headers=headers)
+    if res is None:
+        return
+    rocket = Rocket(**res.json())
+
+    # Subscribe before launching so the updates are not missed
+    connected = asyncio.Event()
+    ws_url = args.url.replace("http", "ws", 1) + f"/rocket/{rocket.id}/ws"
+    timeout = flight_timeout(rocket, args.timeout_slack)
+    watcher = asyncio.create_task(
+        watch_rocket(ws_url, stats, connected, username, rocket.id, timeout, args.queue_timeout)
+    )
+    await connected.wait()
+
+    res = await launch_with_retries(client, stats, args, rocket.id, headers)
+    if res is None:
+        watcher.cancel()
+        return
+    launched = time.perf_counter()
+    queued = res.status_code == 202
+    stats.flights += 1
+    if queued:
+        stats.queued += 1
+
+    poller = asyncio.create_task(poll_rockets(client, stats, headers, args.poll_interval))
+    try:
+        lifted_off, crashed = await watcher
+    finally:
+        poller.cancel()
+
+    if crashed is None:
+        stats.timeouts += 1
+        return
+
+    # A queued flight only starts once it leaves the queue, keep that wait out of the lag
+    if queued and lifted_off is not None:
+        stats.queue_waits.append(lifted_off - launched)
+        launched = lifted_off
+
+    # How far the flight fell behind the simulated flight time
+    expected = calc_flight_ticks(rocket) * TIME_DELTA
+    stats.lags.append(crashed - launched - expected)
+
+
+async def simulate_user(client: httpx.AsyncClient, stats: Stats, args: argparse.Namespace, index: int):
+    await asyncio.sleep(args.ramp_up * index / args.users)
+    username = f"loadgen-{index}"
+    await asyncio.gather(*(fly_rocket(client, stats, args, username) for _ in range(args.rockets)))
+
+
+async def wait_for_service(url: str, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=url) as client:
+        while time.perf_counter() < deadline:
+            try:
+                if (await client.get("/status")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"Service at {url} did not come up")
+
+
+def start_local_service(port: int) -> subprocess.Popen:
+    """Run the service against in-memory Redis and broker stand-ins"""
+    env = dict(os.environ, LOCAL_BACKENDS="1", STARTUP_TIME="0", JAEGER_HOST="localhost")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=root,
+        env=env,
+    )
+
+
+async def run(args: argparse.Namespace) -> dict:
+    await wait_for_service(args.url)
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.request_timeout) as client:
+        await asyncio.gather(*(simulate_user(client, stats, args, i) for i in range(args.users)))
+    stats.finished = time.perf_counter()
+    return stats.summary()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Soak test a rocket manager instance")
+    parser.add_argument("--url", default="http://localhost:8000", help="Base url of the service")
+    parser.add_argument("--local", action="store_true", help="Start a local instance with in-memory Redis and broker")
+    parser.add_argument("--port", type=int, default=8000, help="Port for the local instance")
+    parser.add_argument("--users", type=int, default=10, help="Number of concurrent users")
+    parser.add_argument("--rockets", type=int, default=1, help="Rockets launched by each user")
+    parser.add_argument("--ramp-up", type=float, default=0, help="Seconds over which to start the users")
+    parser.add_argument("--poll-interval", type=float, default=5, help="Seconds between GET /rockets while flying")
+    parser.add_argument(
+        "--timeout-slack", type=float, default=60, help="Seconds past its simulated flight time to wait for a crash"
+    )
+    parser.add_argument("--queue-timeout", type=float, default=600, help="Seconds to wait for a launch to lift off")
+    parser.add_argument("--launch-retries", type=int, default=3, help="Times to retry a launch rejected with 429")
+    parser.add_argument("--request-timeout", type=float, default=30, help="Seconds before a request fails")
+    parser.add_argument("--max-connections", type=int, default=100, help="HTTP connection pool size")
+    parser.add_argument("--json", action="store_true", help="Print the report as json")
+    args = parser.parse_args(argv)
+    if args.local:
+        args.url = f"http://localhost:{args.port}"
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    service = start_local_service(args.port) if args.local else None
+    try:
+        summary = asyncio.run(run(args))
+    finally:
+        if service is not None:
+            # Realtime sockets that never got an update keep graceful shutdown waiting
+            service.terminate()
+            try:
+                service.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                service.kill()
+                service.wait()
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+from aio_pika import Message
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """Match an AMQP topic binding pattern (`*` is one word, `#` is zero or more)"""
+    return _match(pattern.split("."), routing_key.split("."))
+
+
+def _match(pattern: List[str], words: List[str]) -> bool:
+    if not pattern:
+        return not words
+    if pattern[0] == "#":
+        return any(_match(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    if pattern[0] in ("*", words[0]):
+        return _match(pattern[1:], words[1:])
+    return False
+
+
+class LocalMessage:
+    def __init__(self, body: bytes, headers: Dict[str, Any], routing_key: str):
+        self.body = body
+        self.headers = headers
+        self.routing_key = routing_key
+
+    @asynccontextmanager
+    async def process(self):
+        yield self
+
+
+class LocalQueue:
+    def __init__(self, channel: "LocalChannel", name: str):
+        self.channel = channel
+        self.name = name
+        self.bindings: List[str] = []
+        self.messages: asyncio.Queue = asyncio.Queue()
+
+    async def bind(self, exchange: "LocalExchange", routing_key: str):
+        self.bindings.append(routing_key)
+        exchange.queues[self.name] = self
+
+    async def delete(self):
+        self.channel.queues.pop(self.name, None)
+        self.channel.exchange.queues.pop(self.name, None)
+
+    @asynccontextmanager
+    async def iterator(self):
+        yield self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> LocalMessage:
+        return await self.messages.get()
+
+
+class LocalExchange:
+    def __init__(self, name: str):
+        self.name = name
+        self.queues: Dict[str, LocalQueue] = {}
+
+    async def publish(self, message: Message, routing_key: str):
+        for queue in list(self.queues.values()):
+            if any(topic_matches(b, routing_key) for b in queue.bindings):
+                queue.messages.put_nowait(LocalMessage(message.body, dict(message.headers or {}), routing_key))
+
+
+class LocalChannel:
+    """In-memory stand-in for the parts of an aio_pika channel used by Handlers"""
+
+    def __init__(self):
+        self.exchange: Optional[LocalExchange] = None
+        self.queues: Dict[str, LocalQueue] = {}
+
+    async def declare_exchange(self, name: str, *args, **kwargs) -> LocalExchange:
+        if self.exchange is None:
+            self.exchange = LocalExchange(name)
+        return self.exchange
+
+    async def declare_queue(self, name: str, *args, **kwargs) -> LocalQueue:
+        if name not in self.queues:
+            self.queues[name] = LocalQueue(self, name)
+        return self.queues[name]
+
+
+class LocalBroker:
+    def __init__(self):
+        self._channel = LocalChannel()
+
+    async def channel(self) -> LocalChannel:
+        return self._channel
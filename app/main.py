@@ -8,14 +8,18 @@ from jaeger_client import Config
 from opentracing.scope_managers.contextvars import ContextVarsScopeManager
 
 from fastapi import Depends, FastAPI, status, HTTPException, WebSocket, WebSocketDisconnect, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 
-from app import __root__, __service__, __version__, __startup_time__, JAEGER_HOST, JAEGER_PORT
+from app import (__root__, __service__, __version__, __startup_time__, JAEGER_HOST, JAEGER_PORT, LAUNCH_QUEUE_SIZE,
+                 LAUNCH_RETRY_AFTER, LAZY_FLIGHTS, LOCAL_BACKENDS, PROFILE_MAX_SECONDS, TIME_DELTA)
 from app.handlers import Handlers
 from app.models import Rocket, RocketBase
-from app.rockets import (calc_initial_fuel, generate_unique_id, get_rocket,
-                         get_rockets_for_user, set_rocket)
-from app.security import get_username_from_token
+from app.rockets import (LAUNCH_PENDING, LAUNCH_QUEUE_FULL, LAUNCH_USER_LIMIT, calc_initial_fuel, claim_launch,
+                         find_rocket_owner, generate_unique_id, get_rocket, get_rockets_for_user, launch, set_rocket)
+from app.profiler import SamplingProfiler
+from app.security import get_admin_from_token, get_username_from_token
 from app.tracing import TracingMiddleWare
 
 
@@ -64,9 +68,15 @@ app.add_middleware(TracingMiddleWare, tracer=jaeger_tracer)
 async def startup():
     # Wait for RabbitMQ and Redis
     await asyncio.sleep(__startup_time__)
-    await Handlers().init()
+    await Handlers().init(local=LOCAL_BACKENDS)
     asyncio.create_task(Handlers().crash_check())
-    asyncio.create_task(Handlers().launcher())
+    if LAZY_FLIGHTS:
+        asyncio.create_task(Handlers().scheduler())
+    else:
+        asyncio.create_task(Handlers().launcher())
+    if LAUNCH_QUEUE_SIZE:
+        asyncio.create_task(Handlers().admitter())
+    asyncio.create_task(Handlers().sweeper())
 
 
 @app.get("/")
@@ -100,7 +110,7 @@ async def create_rocket(
 async def get_user_rockets(
     *, username: str = Depends(get_username_from_token)
 ):
-    return await get_rockets_for_user(username)
+    return await get_rockets_for_user(username, replica=True)
 
 
 @app.put("/rockets/{id}", response_model=Rocket)
@@ -138,18 +148,69 @@ async def launch_rocket(
 ):
     # 1. Get rocket from database with id
     rocket = await get_rocket(id, username)
-    rocket.launched = True
-    rocket.status = "Lift off! 🤘"
-    await set_rocket(rocket, username)
+    if rocket.launched or rocket.crashed:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            "Rocket has already been launched",
+        )
 
-    # 3. Send rocket launch event
-    msg = {
-        "rocket": rocket.dict(),
-        "username": username
-    }
-    topic = f"rocket.{rocket.id}.launched"
-    await Handlers().send_msg(json.dumps(msg), topic)
-    return rocket
+    # 2. Make sure there is room for it, otherwise queue or turn it away
+    result = await claim_launch(rocket, username)
+    retry_after = {"Retry-After": str(LAUNCH_RETRY_AFTER)}
+    if result == LAUNCH_PENDING:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            "Rocket has already been launched",
+        )
+    if result == LAUNCH_USER_LIMIT:
+        raise HTTPException(
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            "Too many rockets in flight, wait for some to land",
+            headers=retry_after,
+        )
+    if result == LAUNCH_QUEUE_FULL:
+        raise HTTPException(
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            "Launches are busy, try again later",
+            headers=retry_after,
+        )
+    if result > 0:
+        rocket.status = "Queued for launch ⏳"
+        return JSONResponse(
+            jsonable_encoder(rocket),
+            status_code=status.HTTP_202_ACCEPTED,
+            headers={"X-Queue-Position": str(result)},
+        )
+
+    # 3. Save as launched and send rocket launch event
+    return await launch(rocket, username)
+
+
+@app.post("/admin/profile")
+async def profile(
+    seconds: float = 10,
+    interval: float = 0.005,
+    block_threshold: float = 0.1,
+    username: str = Depends(get_admin_from_token)
+):
+    # Sample whatever the event loop is running (tick loop, consumers and requests) for a while
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            f"Profile window must be between 0 and {PROFILE_MAX_SECONDS} seconds",
+        )
+    if interval < 0.001 or block_threshold <= interval:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            "Interval must be at least 1ms and shorter than the block threshold",
+        )
+    if not SamplingProfiler.lock.acquire(blocking=False):
+        raise HTTPException(status.HTTP_409_CONFLICT, "A profile is already running")
+    try:
+        logger.info(f"Profiling for {seconds}s, requested by {username}")
+        return await SamplingProfiler(interval, block_threshold).run(seconds)
+    finally:
+        SamplingProfiler.lock.release()
 
 
 @app.websocket("/rocket/{id}/ws")
@@ -160,6 +221,9 @@ async def rocket_realtime(
     # Accept the websocket
     await websocket.accept()
 
+    if LAZY_FLIGHTS:
+        return await stream_rocket(websocket, id)
+
     try:
         # Create a queue to monitor the rocket update events:
         queue = await Handlers().channel.declare_queue(f"realtime-{id}")
@@ -174,3 +238,36 @@ async def rocket_realtime(
 
     except WebSocketDisconnect:
         await queue.delete()
+
+
+async def stream_rocket(websocket: WebSocket, id: str):
+    # No per-tick events in lazy mode, so compute the state while someone is watching
+    username = await find_rocket_owner(id)
+    if username is None:
+        return await websocket.close()
+
+    # Nothing else reads from the socket, so listen for the client going away
+    disconnected = asyncio.create_task(wait_for_disconnect(websocket))
+    last = None
+    try:
+        while not disconnected.done():
+            rocket = await get_rocket(id, username, replica=True)
+            msg = json.dumps({
+                "rocket": rocket.dict(),
+                "username": username
+            })
+            if msg != last:
+                await websocket.send_text(msg)
+                last = msg
+            if rocket.crashed:
+                return await websocket.close()
+            await asyncio.wait({disconnected}, timeout=TIME_DELTA)
+    except (KeyError, WebSocketDisconnect):
+        pass
+    finally:
+        disconnected.cancel()
+
+
+async def wait_for_disconnect(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
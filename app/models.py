@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel, validator
 
 from app import MAX_ENGINES, MAX_HEIGHT, MIN_ENGINES, MIN_HEIGHT
@@ -33,3 +35,4 @@ class Rocket(RocketBase):
     launched: bool = False
     max_altitude: float = 0
     status: str = "Ready! 🚀"
+    launched_at: Optional[float] = None
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from functools import lru_cache
+from types import FrameType
+from typing import Any, Dict, List, Optional
+
+
+class SamplingProfiler:
+    """Samples the event loop thread from a background thread for a bounded window
+
+    Stacks are aggregated in collapsed-stack format (one `frame;frame;frame count`
+    line per distinct stack, rooted at the running task) ready for flamegraph tools.
+    A heartbeat coroutine on the loop detects callbacks that block it for longer
+    than `block_threshold` seconds, and the stack seen while blocked is recorded.
+    """
+
+    # Only one profile at a time, held by the caller for the whole window
+    lock = threading.Lock()
+
+    def __init__(self, interval: float = 0.005, block_threshold: float = 0.1):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.stacks: Counter = Counter()
+        self.blocks: List[Dict[str, Any]] = []
+        self.samples = 0
+        self._beat = time.monotonic()
+        self._stop = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id: Optional[int] = None
+
+    async def run(self, seconds: float) -> Dict[str, Any]:
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        sampler = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        sampler.start()
+        try:
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                self._beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+        finally:
+            self._stop.set()
+            sampler.join()
+        return self.report(seconds)
+
+    def report(self, seconds: float) -> Dict[str, Any]:
+        return {
+            "seconds": seconds,
+            "samples": self.samples,
+            "stacks": "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()),
+            "blocking": sorted(self.blocks, key=lambda b: b["duration"], reverse=True),
+        }
+
+    def _sample(self):
+        block: Optional[Dict[str, Any]] = None
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = self._collapse(frame)
+            self.stacks[stack] += 1
+            self.samples += 1
+
+            # The heartbeat hasn't run, so whatever is on the loop is holding it up
+            stalled = time.monotonic() - self._beat
+            if stalled > self.block_threshold:
+                if block is None:
+                    block = {"stack": stack, "duration": stalled}
+                    self.blocks.append(block)
+                block["duration"] = stalled
+            else:
+                block = None
+
+    def _collapse(self, frame: Optional[FrameType]) -> str:
+        frames = []
+        while frame is not None:
+            frames.append(f"{_short_path(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        frames.append(self._task_name())
+        return ";".join(reversed(frames))
+
+    def _task_name(self) -> str:
+        task = asyncio.current_task(self._loop)
+        if task is None:
+            return "<loop>"
+        return getattr(task.get_coro(), "__qualname__", task.get_name())
+
+
+@lru_cache(maxsize=None)
+def _short_path(filename: str) -> str:
+    """Path relative to the sys.path entry it was imported from"""
+    roots = [p for p in sys.path if p and filename.startswith(p.rstrip(os.sep) + os.sep)]
+    if not roots:
+        return filename
+    return filename[len(max(roots, key=len).rstrip(os.sep)) + 1:]
@@ -1,12 +1,15 @@
 import asyncio
 import json
 import logging
+import time
 import opentracing
 
-from typing import List
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from math import pi
 
-from app import MASS_FLOW, RF_DENSITY, TIME_DELTA, WALL_THICKNESS
+from app import (LAUNCH_QUEUE_SIZE, LAUNCH_SWEEP_INTERVAL, LAZY_FLIGHTS, MASS_FLOW, MAX_IN_FLIGHT, MAX_TICK_LAG,
+                 MAX_USER_IN_FLIGHT, RF_DENSITY, TIME_DELTA, WALL_THICKNESS)
 from app.security import get_random_word
 from app.handlers import Handlers
 from app.models import Rocket, RocketBase
@@ -14,6 +17,64 @@ from app.models import Rocket, RocketBase
 
 logger = logging.getLogger(__name__)
 
+FLIGHT_EVENTS = "flight-events"
+
+# Last evaluated (tick, state) of lazily launched rockets keyed by (id, launched_at),
+# so repeated reads of a flight only step forward from where the previous read left off
+FLIGHT_CHECKPOINTS: "OrderedDict[Tuple[str, float], Tuple[int, Rocket]]" = OrderedDict()
+MAX_FLIGHT_CHECKPOINTS = 10000
+IN_FLIGHT = "in-flight"
+LAUNCH_QUEUE = "launch-queue"
+
+# Stored json of each in flight rocket at the previous sweep, a ticked flight that hasn't changed stopped ticking
+SWEEP_SEEN: Dict[str, str] = {}
+
+# claim_launch results, a positive result is the position in the launch queue
+LAUNCH_NOW = 0
+LAUNCH_PENDING = -1
+LAUNCH_USER_LIMIT = -2
+LAUNCH_QUEUE_FULL = -3
+
+# Checks and reserves a launch slot in one step so concurrent launches can't overshoot the limits
+# KEYS: user launches, in flight, launch queue, rocket
+# ARGV: id, in flight member, max user, max in flight, queue size, fleet lagging, queued rocket json
+CLAIM_LAUNCH = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    return -1
+end
+local max_user = tonumber(ARGV[3])
+if max_user > 0 and redis.call('SCARD', KEYS[1]) >= max_user then
+    return -2
+end
+local max_in_flight = tonumber(ARGV[4])
+local busy = ARGV[6] == '1' or (max_in_flight > 0 and redis.call('SCARD', KEYS[2]) >= max_in_flight)
+if busy and redis.call('LLEN', KEYS[3]) >= tonumber(ARGV[5]) then
+    return -3
+end
+redis.call('SADD', KEYS[1], ARGV[1])
+if not busy then
+    redis.call('SADD', KEYS[2], ARGV[2])
+    return 0
+end
+redis.call('SET', KEYS[4], ARGV[7])
+return redis.call('RPUSH', KEYS[3], ARGV[2])
+"""
+
+# Pops the next queued launch and marks it in flight if there is room
+# KEYS: in flight, launch queue
+# ARGV: max in flight
+ADMIT_LAUNCH = """
+local max_in_flight = tonumber(ARGV[1])
+if max_in_flight > 0 and redis.call('SCARD', KEYS[1]) >= max_in_flight then
+    return false
+end
+local key = redis.call('LPOP', KEYS[2])
+if key then
+    redis.call('SADD', KEYS[1], key)
+end
+return key
+"""
+
 
 def calc_initial_fuel(rocket: RocketBase) -> float:
     dia = calc_rocket_diameter(rocket.num_engines)
@@ -66,10 +127,94 @@ def calc_rocket_fuel(rocket: Rocket) -> float:
     return (MASS_FLOW * rocket.num_engines * TIME_DELTA) / RF_DENSITY
 
 
+def step_rocket(rocket: Rocket) -> bool:
+    """Advance the rocket by one tick, returns True if it ran out of fuel on this tick"""
+    # Linear acceleration
+    acc = calc_acceleration(rocket)
+    d_pos = 0.5 * acc * TIME_DELTA**2 + rocket.velocity * TIME_DELTA
+
+    # Update rocket values
+    rocket.altitude += d_pos
+    rocket.velocity += acc * TIME_DELTA
+
+    out_of_fuel = False
+    if rocket.fuel > 0:
+        d_fuel = calc_rocket_fuel(rocket)
+        rocket.fuel -= d_fuel
+        if rocket.fuel < 0:
+            rocket.fuel = 0
+            rocket.status = "Out of fuel 😭⛽"
+            out_of_fuel = True
+
+    # Update max altitude
+    if rocket.altitude > rocket.max_altitude:
+        rocket.max_altitude = rocket.altitude
+
+    return out_of_fuel
+
+
+def has_landed(rocket: Rocket) -> bool:
+    return rocket.fuel <= 0 and rocket.altitude <= 0
+
+
+def calc_flight_events(rocket: Rocket) -> Tuple[Optional[int], int]:
+    """Ticks from launch until the rocket runs out of fuel and until it crash lands"""
+    rocket = rocket.copy()
+    nofuel = None
+    ticks = 0
+    while True:
+        ticks += 1
+        if step_rocket(rocket):
+            nofuel = ticks
+        if has_landed(rocket):
+            return nofuel, ticks
+
+
+def calc_flight_ticks(rocket: Rocket) -> int:
+    """Number of ticks from launch until the rocket crash lands"""
+    return calc_flight_events(rocket)[1]
+
+
+def calc_rocket_state(rocket: Rocket, now: float) -> Rocket:
+    """Evaluate a lazily launched rocket at time `now` from its launch state"""
+    if rocket.crashed or rocket.launched_at is None:
+        return rocket
+
+    # Small tolerance so events scheduled for exactly a tick see that tick
+    target = int((now - rocket.launched_at) / TIME_DELTA + 1e-6)
+    key = (rocket.id, rocket.launched_at)
+    tick, state = FLIGHT_CHECKPOINTS.get(key, (0, rocket))
+    if tick > target:
+        tick, state = 0, rocket
+
+    state = state.copy()
+    while tick < target:
+        step_rocket(state)
+        tick += 1
+        if has_landed(state):
+            state.crashed = True
+            state.status = "Crash landed 🔥🚒"
+            state.altitude = 0
+            break
+
+    if state.crashed:
+        FLIGHT_CHECKPOINTS.pop(key, None)
+    else:
+        FLIGHT_CHECKPOINTS[key] = (tick, state.copy())
+        FLIGHT_CHECKPOINTS.move_to_end(key)
+        if len(FLIGHT_CHECKPOINTS) > MAX_FLIGHT_CHECKPOINTS:
+            FLIGHT_CHECKPOINTS.popitem(last=False)
+    return state
+
+
 def get_key(id: str, username: str) -> str:
     return f"{username}:{id}"
 
 
+def get_launches_key(username: str) -> str:
+    return f"launches:{username}"
+
+
 async def rocket_exists(id: str, username: str) -> bool:
     with opentracing.tracer.start_active_span("rocket_exists") as scope:
         res = (await Handlers().redis.exists(get_key(id, username))) >= 1
@@ -79,49 +224,219 @@ async def rocket_exists(id: str, username: str) -> bool:
 
 async def rocket_id_exists(id: str) -> bool:
     with opentracing.tracer.start_active_span("rocket_id_exists") as scope:
-        res = (await Handlers().redis.exists(f"*:{id}")) >= 1
+        # EXISTS doesn't expand patterns, ids are unique across users so scan for any owner
+        res = (await find_rocket_owner(id)) is not None
         scope.span.log_kv({"result": res})
         return res
 
 
+async def find_rocket_owner(id: str) -> Optional[str]:
+    # Primary only, the rocket has usually just been created so a replica may not have it yet
+    async for key in Handlers().redis.scan_iter(f"*:{id}"):
+        return key.rsplit(":", 1)[0]
+    return None
+
+
 async def set_rocket(rocket: Rocket, username):
     with opentracing.tracer.start_active_span("set_rocket") as scope:
         scope.span.log_kv(rocket.dict())
         await Handlers().redis.set(get_key(rocket.id, username), rocket.json())
 
 
-async def get_rockets_for_user(username: str) -> List[Rocket]:
+async def get_rockets_for_user(username: str, replica: bool = False) -> List[Rocket]:
     with opentracing.tracer.start_active_span("get_rockets_for_user") as scope:
         rockets: List[Rocket] = []
         scope.span.set_tag("user", username)
-        async for key in Handlers().redis.scan_iter(f"{username}:*"):
-            raw = await Handlers().redis.get(key)
-            rockets.append(Rocket(**json.loads(raw)))
+
+        async def read_rockets(redis) -> list:
+            keys = [key async for key in redis.scan_iter(f"{username}:*")]
+            return await redis.mget(keys) if keys else []
+
+        stored = await (Handlers().read(read_rockets) if replica else read_rockets(Handlers().redis_raw))
+        now = time.time()
+        for raw in stored:
+            # Deleted between the scan and the get
+            if raw is not None:
+                rockets.append(calc_rocket_state(Rocket(**json.loads(raw)), now))
         scope.span.set_tag("rockets", len(rockets))
         return rockets
 
 
-async def get_rocket(id: str, username: str) -> Rocket:
+async def get_rocket(id: str, username: str, evaluate: bool = True, replica: bool = False) -> Rocket:
     with opentracing.tracer.start_active_span("get_rocket") as scope:
-        if await rocket_exists(id, username):
-            raw = await Handlers().redis.get(get_key(id, username))
-            rocket = Rocket(**json.loads(raw))
-            scope.span.log_kv(rocket.dict())
-            return rocket
-        else:
+        key = get_key(id, username)
+        raw = await (Handlers().read(lambda redis: redis.get(key)) if replica else Handlers().redis_raw.get(key))
+        if raw is None:
             err = f"Rocket with id: {id} not found"
             scope.span.log_kv({"error": err})
             raise KeyError(err)
 
+        rocket = Rocket(**json.loads(raw))
+        if evaluate:
+            rocket = calc_rocket_state(rocket, time.time())
+        scope.span.log_kv(rocket.dict())
+        return rocket
+
 
 async def delete_rocket(id: str, username: str):
     with opentracing.tracer.start_active_span("delete_rocket") as scope:
         rocket = await get_rocket(id, username)
         await Handlers().redis.delete(get_key(id, username))
+        await release_launch(id, username)
+        await Handlers().redis.lrem(LAUNCH_QUEUE, 0, get_key(id, username))
         scope.span.log_kv(rocket.dict())
         return rocket
 
 
+async def launch(rocket: Rocket, username: str) -> Rocket:
+    rocket.launched = True
+    rocket.status = "Lift off! 🤘"
+    if LAZY_FLIGHTS:
+        rocket.launched_at = time.time()
+    await set_rocket(rocket, username)
+
+    await Handlers().redis.sadd(IN_FLIGHT, get_key(rocket.id, username))
+    await Handlers().redis.sadd(get_launches_key(username), rocket.id)
+
+    if LAZY_FLIGHTS:
+        # Driven by the scheduled events, the launcher leaves rockets with launched_at alone
+        await schedule_flight_events(rocket, username)
+
+    msg = {
+        "rocket": rocket.dict(),
+        "username": username,
+        "sent_at": time.time()
+    }
+    await Handlers().send_msg(json.dumps(msg), f"rocket.{rocket.id}.launched")
+    return rocket
+
+
+async def release_launch(id: str, username: str):
+    await Handlers().redis.srem(IN_FLIGHT, get_key(id, username))
+    await Handlers().redis.srem(get_launches_key(username), id)
+
+
+def fleet_lagging() -> bool:
+    return bool(MAX_TICK_LAG) and Handlers().current_tick_lag() > MAX_TICK_LAG
+
+
+async def claim_launch(rocket: Rocket, username: str) -> int:
+    """Reserve a launch slot or a place in the launch queue, see the LAUNCH_* results"""
+    with opentracing.tracer.start_active_span("claim_launch") as scope:
+        queued = rocket.copy(update={"status": "Queued for launch ⏳"})
+        claim = Handlers().redis.register_script(CLAIM_LAUNCH)
+        result = await claim(
+            keys=[get_launches_key(username), IN_FLIGHT, LAUNCH_QUEUE, get_key(rocket.id, username)],
+            args=[
+                rocket.id,
+                get_key(rocket.id, username),
+                MAX_USER_IN_FLIGHT,
+                MAX_IN_FLIGHT,
+                LAUNCH_QUEUE_SIZE,
+                int(fleet_lagging()),
+                queued.json(),
+            ],
+        )
+        scope.span.log_kv({"result": result})
+        return result
+
+
+async def admit_launches():
+    admit = Handlers().redis.register_script(ADMIT_LAUNCH)
+    while not fleet_lagging():
+        key = await admit(keys=[IN_FLIGHT, LAUNCH_QUEUE], args=[MAX_IN_FLIGHT])
+        if key is None:
+            return
+        username, id = key.rsplit(":", 1)
+        try:
+            rocket = await get_rocket(id, username)
+        except KeyError:
+            await release_launch(id, username)
+            continue
+        await launch(rocket, username)
+
+
+async def sweep_launches():
+    """Release launch slots the flight didn't release itself
+
+    Slots are only released by crash_rocket and delete_rocket, so a tick that
+    failed or a lost message would otherwise hold the slot forever.
+    """
+    with opentracing.tracer.start_active_span("sweep_launches") as scope:
+        released = 0
+        seen = {}
+        keys = list(await Handlers().redis.smembers(IN_FLIGHT))
+        stored = await Handlers().redis.mget(keys) if keys else []
+        # A backed up launcher can legitimately leave a flight untouched for a while
+        ticking = Handlers().current_tick_lag() < LAUNCH_SWEEP_INTERVAL
+        for key, raw in zip(keys, stored):
+            username, id = key.rsplit(":", 1)
+            rocket = Rocket(**json.loads(raw)) if raw is not None else None
+            if rocket is not None and not rocket.crashed:
+                if rocket.launched_at is not None:
+                    # Lazy flight whose crash event was lost, crash it now the scheduler had its chance
+                    landed = calc_rocket_state(rocket, time.time() - LAUNCH_SWEEP_INTERVAL)
+                    if landed.crashed:
+                        await crash_rocket(landed, username, landed.status)
+                        released += 1
+                    continue
+                if not ticking or SWEEP_SEEN.get(key) != raw:
+                    seen[key] = raw
+                    continue
+                logger.warning(f"Rocket {id} stopped ticking, releasing its launch slot")
+            await release_launch(id, username)
+            released += 1
+        SWEEP_SEEN.clear()
+        SWEEP_SEEN.update(seen)
+
+        # Per user claims of rockets that are gone or done, queued launches are left alone
+        async for launches_key in Handlers().redis.scan_iter(get_launches_key("*")):
+            username = launches_key.split(":", 1)[1]
+            for id in await Handlers().redis.smembers(launches_key):
+                raw = await Handlers().redis.get(get_key(id, username))
+                if raw is None or Rocket(**json.loads(raw)).crashed:
+                    await Handlers().redis.srem(launches_key, id)
+                    released += 1
+        scope.span.log_kv({"released": released})
+        return released
+
+
+async def schedule_flight_events(rocket: Rocket, username: str):
+    with opentracing.tracer.start_active_span("schedule_flight_events") as scope:
+        nofuel, crashed = calc_flight_events(rocket)
+        events = {}
+        if nofuel is not None:
+            events[json.dumps({"event": "nofuel", "id": rocket.id, "username": username})] = rocket.launched_at + nofuel * TIME_DELTA
+        events[json.dumps({"event": "crashed", "id": rocket.id, "username": username})] = rocket.launched_at + crashed * TIME_DELTA
+        scope.span.log_kv({"nofuel": nofuel, "crashed": crashed})
+        await Handlers().redis.zadd(FLIGHT_EVENTS, events)
+
+
+async def handle_flight_event(event: dict):
+    with opentracing.tracer.start_active_span("handle_flight_event") as scope:
+        scope.span.log_kv(event)
+        username = event["username"]
+        try:
+            stored = await get_rocket(event["id"], username, evaluate=False)
+        except KeyError:
+            # Deleted before the event was due
+            return
+
+        # Crashed by something else first, nothing left to do
+        if stored.crashed:
+            return
+
+        rocket = calc_rocket_state(stored, time.time())
+        if event["event"] == "nofuel":
+            msg = {
+                "rocket": rocket.dict(),
+                "username": username
+            }
+            await Handlers().send_msg(json.dumps(msg), f"rocket.{rocket.id}.nofuel")
+        elif event["event"] == "crashed":
+            await crash_rocket(rocket, username, rocket.status)
+
+
 async def update_rocket(rocket: Rocket, username: str) -> Rocket:
     if rocket.crashed:
         return rocket
@@ -140,31 +455,14 @@ async def update_rocket(rocket: Rocket, username: str) -> Rocket:
         await Handlers().send_msg(json.dumps(msg), f"rocket.{rocket.id}.updated")
         return latest_rocket
 
-    # Linear acceleration
-    acc = calc_acceleration(rocket)
-    d_pos = 0.5 * acc * TIME_DELTA**2 + rocket.velocity * TIME_DELTA
-
-    # Update rocket values
-    rocket.altitude += d_pos
-    rocket.velocity += acc * TIME_DELTA
-
-    if rocket.fuel > 0:
-        d_fuel = calc_rocket_fuel(rocket)
-        rocket.fuel -= d_fuel
-        if rocket.fuel < 0:
-            rocket.fuel = 0
-            rocket.status = "Out of fuel 😭⛽"
-            await Handlers().send_msg(json.dumps({
-                "rocket": rocket.dict(),
-                "username": username
-            }), f"rocket.{rocket.id}.nofuel")
-
-    # Update max altitude
-    if rocket.altitude > rocket.max_altitude:
-        rocket.max_altitude = rocket.altitude
+    if step_rocket(rocket):
+        await Handlers().send_msg(json.dumps({
+            "rocket": rocket.dict(),
+            "username": username
+        }), f"rocket.{rocket.id}.nofuel")
 
     # Save in database
-    if rocket.fuel <= 0 and rocket.altitude <= 0:
+    if has_landed(rocket):
         rocket = await crash_rocket(rocket, username, "Crash landed 🔥🚒")
         rocket.altitude = 0
 
@@ -173,7 +471,8 @@ async def update_rocket(rocket: Rocket, username: str) -> Rocket:
         await Handlers().redis.set(get_key(rocket.id, username), rocket.json())
         msg = {
             "rocket": rocket.dict(),
-            "username": username
+            "username": username,
+            "sent_at": time.time()
         }
 
     await Handlers().send_msg(json.dumps(msg), f"rocket.{rocket.id}.updated")
@@ -189,6 +488,7 @@ async def crash_rocket(rocket: Rocket, username: str, status: str) -> Rocket:
         scope.span.log_kv(rocket.dict())
 
         await Handlers().redis.set(get_key(rocket.id, username), rocket.json())
+        await release_launch(rocket.id, username)
         msg = {
             "rocket": rocket.dict(),
             "username": username
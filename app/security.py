@@ -8,7 +8,7 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi.exceptions import HTTPException
 from jose import JWTError, jwt
 
-from app import USER_SECRET, USER_URL
+from app import ADMIN_USERS, USER_SECRET, USER_URL
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=USER_URL)
 
@@ -37,6 +37,26 @@ async def get_username_from_token(token: str = Depends(oauth2_scheme)) -> str:
     return username
 
 
+async def get_admin_from_token(username: str = Depends(get_username_from_token)) -> str:
+    if username not in ADMIN_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return username
+
+
+def create_token(username: str, expires_delta: datetime.timedelta = datetime.timedelta(hours=1)) -> str:
+    """Mint a token the same way the user manager does, used for load testing"""
+    payload = {
+        "sub": username,
+        "aud": "micro-rocket",
+        "iss": "user-manager",
+        "exp": datetime.datetime.utcnow() + expires_delta,
+    }
+    return jwt.encode(payload, USER_SECRET, algorithm="HS256")
+
+
 def get_random_word() -> str:
     global WORDS
     if len(WORDS) == 0:
@@ -1,6 +1,5 @@
 import uuid
 import pytest
-import fakeredis.aioredis
 
 from app.models import Rocket, RocketBase
 from app.rockets import calc_initial_fuel
@@ -10,7 +9,7 @@ from app.handlers import Handlers
 @pytest.fixture
 def handlers():
     handlers = Handlers()
-    handlers.redis = fakeredis.aioredis.FakeRedis()
+    handlers.init_local_redis()
     return handlers
 
 
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+import pytest
+import aioredis
+import fakeredis
+import fakeredis.aioredis
+
+from aio_pika import Message
+
+from app.handlers import REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, Handlers, redis_client
+from app.local import LocalBroker
+from app.rockets import find_rocket_owner, get_rocket, get_rockets_for_user, set_rocket
+
+
+def test_redis_client():
+    client = redis_client("localhost", decode_responses=False)
+    assert client.connection_pool.max_connections == REDIS_MAX_CONNECTIONS
+    assert client.connection_pool.timeout == REDIS_POOL_TIMEOUT
+
+
+@pytest.mark.asyncio
+async def test_replica_reads(rocket, handlers, mocker):
+    assert handlers.reader() in handlers.replicas
+
+    await set_rocket(rocket, "replica")
+    assert await get_rocket(rocket.id, "replica", replica=True) == rocket
+    assert await get_rockets_for_user("replica", replica=True) == [rocket]
+
+    # Without replicas everything is read from the primary
+    mocker.patch.object(handlers, "replicas", [])
+    assert handlers.reader() is handlers.redis_raw
+    assert await get_rockets_for_user("replica", replica=True) == [rocket]
+    assert await get_rockets_for_user("nobody", replica=True) == []
+
+
+@pytest.mark.asyncio
+async def test_replica_read_falls_back(rocket, handlers, mocker):
+    await set_rocket(rocket, "replica")
+    replica = handlers.replicas[0]
+    mocker.patch.object(replica, "get", side_effect=aioredis.ConnectionError("replica down"))
+    mocker.patch.object(replica, "scan_iter", side_effect=aioredis.TimeoutError("replica slow"))
+
+    assert await get_rocket(rocket.id, "replica", replica=True) == rocket
+    assert await get_rockets_for_user("replica", replica=True) == [rocket]
+
+    # Nowhere left to go when the primary fails too
+    mocker.patch.object(handlers, "replicas", [])
+    mocker.patch.object(handlers.redis_raw, "get", side_effect=aioredis.ConnectionError("primary down"))
+    with pytest.raises(aioredis.ConnectionError):
+        await get_rocket(rocket.id, "replica", replica=True)
+
+
+@pytest.mark.asyncio
+async def test_lazy_crash_check_skips_unknown(rocket, handlers, mocker):
+    mocker.patch("app.handlers.LAZY_FLIGHTS", True)
+    mocker.patch.object(Handlers, "send_msg")
+    mocker.patch.object(handlers, "rabbitmq", LocalBroker(), create=True)
+    mocker.patch.object(handlers, "channel", await handlers.rabbitmq.channel(), create=True)
+    mocker.patch.object(handlers, "exchange", await handlers.channel.declare_exchange("micro-rockets"), create=True)
+    await set_rocket(rocket, "test")
+
+    task = asyncio.create_task(handlers.crash_check())
+    await asyncio.sleep(0)
+
+    ghost = rocket.copy(update={"id": "ghost"})
+    for r in (ghost, rocket):
+        msg = json.dumps({"rocket": r.dict(), "username": "test"})
+        await handlers.exchange.publish(Message(body=msg.encode()), routing_key=f"rocket.{r.id}.crashed")
+
+    for _ in range(100):
+        if (await get_rocket(rocket.id, "test", evaluate=False)).crashed:
+            break
+        await asyncio.sleep(0.01)
+    assert not task.done()
+    task.cancel()
+    assert (await get_rocket(rocket.id, "test", evaluate=False)).crashed
+
+
+@pytest.mark.asyncio
+async def test_owner_lookup_uses_primary(rocket, handlers, mocker):
+    await set_rocket(rocket, "owner")
+    # A lagging replica that hasn't seen the rocket yet
+    mocker.patch.object(handlers, "replicas", [fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())])
+    assert await find_rocket_owner(rocket.id) == "owner"
+
+
+@pytest.mark.asyncio
+async def test_tick_lag_after_processing(rocket, handlers, mocker):
+    mocker.patch.object(handlers, "rabbitmq", LocalBroker(), create=True)
+    mocker.patch.object(handlers, "channel", await handlers.rabbitmq.channel(), create=True)
+    mocker.patch.object(handlers, "exchange", await handlers.channel.declare_exchange("micro-rockets"), create=True)
+    mocker.patch.object(handlers, "tick_lag_at", 0.0)
+    mocker.patch.object(handlers, "tick_lag", 0.0)
+    update = mocker.patch("app.rockets.update_rocket", side_effect=RuntimeError("tick failed"))
+
+    task = asyncio.create_task(handlers.launcher())
+    await asyncio.sleep(0)
+    sent_at = time.time() - 5
+    msg = json.dumps({"rocket": rocket.dict(), "username": "test", "sent_at": sent_at})
+    await handlers.exchange.publish(Message(body=msg.encode()), routing_key=f"rocket.{rocket.id}.updated")
+
+    for _ in range(100):
+        if handlers.tick_lag_at:
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    update.assert_called_once()
+    # Recorded once the tick is done, even though it failed
+    assert handlers.tick_lag >= 5
+    assert handlers.tick_lag_at > sent_at + 5
+
+
+@pytest.mark.asyncio
+async def test_launcher_skips_lazy_flights(rocket, handlers, mocker):
+    mocker.patch.object(handlers, "rabbitmq", LocalBroker(), create=True)
+    mocker.patch.object(handlers, "channel", await handlers.rabbitmq.channel(), create=True)
+    mocker.patch.object(handlers, "exchange", await handlers.channel.declare_exchange("micro-rockets"), create=True)
+    update = mocker.patch("app.rockets.update_rocket")
+
+    task = asyncio.create_task(handlers.launcher())
+    await asyncio.sleep(0)
+    for r in (rocket.copy(update={"launched_at": time.time()}), rocket):
+        msg = json.dumps({"rocket": r.dict(), "username": "test"})
+        await handlers.exchange.publish(Message(body=msg.encode()), routing_key=f"rocket.{r.id}.launched")
+
+    for _ in range(100):
+        if update.called:
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    # Only the ticked flight is stepped
+    update.assert_called_once()
+    assert update.call_args[0][0].launched_at is None
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import pytest
+import websockets
+
+from app import TIME_DELTA
+from app.loadgen import Stats, flight_timeout, format_summary, parse_args, percentile, watch_rocket
+from app.rockets import calc_flight_ticks
+from app.security import create_token, get_username_from_token
+
+
+def test_percentile():
+    assert percentile([], 50) == 0
+    assert percentile([3.0], 99) == 3.0
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+
+
+def test_stats_summary():
+    stats = Stats()
+    stats.record("create", 0.1)
+    stats.record("create", 0.3, ok=False)
+    stats.lags.append(1.5)
+    stats.queue_waits.append(4.0)
+    stats.flights = 2
+    stats.timeouts = 1
+    stats.retries = 3
+    stats.rejected = 1
+
+    summary = stats.summary()
+    assert summary["requests"] == 2
+    assert summary["operations"]["create"]["error_rate"] == 0.5
+    assert summary["operations"]["create"]["max"] == 0.3
+    assert summary["flights"]["completed"] == 1
+    assert summary["flights"]["lag_max"] == 1.5
+    assert summary["flights"]["queue_wait_max"] == 4.0
+    assert summary["flights"]["rejected"] == 1
+    assert "create" in format_summary(summary)
+    assert "1 launches rejected after 3 retries" in format_summary(summary)
+
+
+def test_local_args():
+    args = parse_args(["--local", "--port", "9000", "--users", "5"])
+    assert args.url == "http://localhost:9000"
+    assert args.users == 5
+
+
+def test_flight_timeout(rocket):
+    # Long flights get as long as they need rather than a fixed timeout
+    assert flight_timeout(rocket, 30) == calc_flight_ticks(rocket) * TIME_DELTA + 30
+    tall = rocket.copy(update={"height": rocket.height * 5, "fuel": rocket.fuel * 5})
+    assert flight_timeout(tall, 30) > flight_timeout(rocket, 30)
+
+
+@pytest.mark.asyncio
+async def test_watch_rocket_ignores_other_users(rocket):
+    launched = rocket.copy(update={"launched": True})
+    crashed = launched.copy(update={"crashed": True})
+
+    async def updates(ws, *args):
+        # Another user's rocket with the same id crashes first
+        for r, username in ((launched, "other"), (crashed, "other"), (launched, "me"), (crashed, "me")):
+            await ws.send(json.dumps({"rocket": r.dict(), "username": username}))
+        await ws.wait_closed()
+
+    async with websockets.serve(updates, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        stats = Stats()
+        lifted_off, landed = await watch_rocket(
+            f"ws://localhost:{port}", stats, asyncio.Event(), "me", rocket.id, 5, 5
+        )
+    assert lifted_off is not None
+    assert landed is not None
+
+    async with websockets.serve(updates, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        lifted_off, landed = await watch_rocket(
+            f"ws://localhost:{port}", stats, asyncio.Event(), "nobody", rocket.id, 5, 0.2
+        )
+    assert (lifted_off, landed) == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_token_round_trip():
+    token = create_token("loadgen-1")
+    assert await get_username_from_token(token) == "loadgen-1"
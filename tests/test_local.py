@@ -0,0 +1,32 @@
+import asyncio
+import pytest
+
+from aio_pika import Message
+
+from app.local import LocalBroker, topic_matches
+
+
+def test_topic_matches():
+    assert topic_matches("rocket.*.launched", "rocket.abc.launched")
+    assert not topic_matches("rocket.*.launched", "rocket.abc.updated")
+    assert not topic_matches("rocket.*", "rocket.abc.launched")
+    assert topic_matches("rocket.#", "rocket.abc.launched")
+    assert topic_matches("#", "rocket")
+
+
+@pytest.mark.asyncio
+async def test_local_publish():
+    channel = await LocalBroker().channel()
+    exchange = await channel.declare_exchange("micro-rockets")
+    queue = await channel.declare_queue("rocket-update")
+    await queue.bind(exchange, "rocket.*.launched")
+
+    await exchange.publish(Message(body=b"ignored"), routing_key="rocket.abc.created")
+    await exchange.publish(Message(body=b"hello"), routing_key="rocket.abc.launched")
+
+    async with queue.iterator() as q_iter:
+        message = await asyncio.wait_for(q_iter.__anext__(), 1)
+        async with message.process():
+            assert message.body == b"hello"
+            assert message.routing_key == "rocket.abc.launched"
+    assert queue.messages.empty()
@@ -1,9 +1,12 @@
+import asyncio
 import pytest
 
+from fastapi import HTTPException
+
 from app.handlers import Handlers
-from app.rockets import get_rocket, set_rocket, update_rocket
+from app.rockets import admit_launches, crash_rocket, get_rocket, set_rocket, update_rocket
 from app.models import RocketBase
-from app.main import create_rocket, launch_rocket
+from app.main import create_rocket, launch_rocket, stream_rocket
 
 
 @pytest.mark.asyncio
@@ -43,3 +46,128 @@ async def test_rocket_launch(handlers, rocket, mocker):
 
         new_rocket = await get_rocket(rocket.id, "test")
         assert new_rocket.altitude > 0
+
+
+@pytest.mark.asyncio
+async def test_launch_admission(handlers, mocker):
+    await handlers.redis.flushall()
+    mocker.patch.object(Handlers, "send_msg")
+    mocker.patch("app.rockets.MAX_IN_FLIGHT", 1)
+    mocker.patch("app.rockets.LAUNCH_QUEUE_SIZE", 1)
+
+    rockets = [await create_rocket(RocketBase(num_engines=4, height=200), "test") for _ in range(3)]
+
+    # Room for the first one
+    assert (await launch_rocket(rockets[0].id, "test")).launched
+
+    # The second waits in the queue
+    res = await launch_rocket(rockets[1].id, "test")
+    assert res.status_code == 202
+    assert res.headers["X-Queue-Position"] == "1"
+
+    # Queue is full, so the third is turned away
+    with pytest.raises(HTTPException) as exc:
+        await launch_rocket(rockets[2].id, "test")
+    assert exc.value.status_code == 429
+    assert "Retry-After" in exc.value.headers
+
+    # Once the first lands the queued rocket gets launched
+    await crash_rocket(rockets[0], "test", "Crash landed 🔥🚒")
+    await admit_launches()
+    assert (await get_rocket(rockets[1].id, "test")).launched
+
+
+@pytest.mark.asyncio
+async def test_user_launch_limit(handlers, mocker):
+    await handlers.redis.flushall()
+    mocker.patch.object(Handlers, "send_msg")
+    mocker.patch("app.rockets.MAX_USER_IN_FLIGHT", 1)
+
+    first = await create_rocket(RocketBase(num_engines=4, height=200), "test")
+    second = await create_rocket(RocketBase(num_engines=4, height=200), "test")
+    await launch_rocket(first.id, "test")
+
+    with pytest.raises(HTTPException) as exc:
+        await launch_rocket(first.id, "test")
+    assert exc.value.status_code == 400
+
+    with pytest.raises(HTTPException) as exc:
+        await launch_rocket(second.id, "test")
+    assert exc.value.status_code == 429
+
+    # Other users are not affected
+    other = await create_rocket(RocketBase(num_engines=4, height=200), "other")
+    assert (await launch_rocket(other.id, "other")).launched
+
+
+@pytest.mark.asyncio
+async def test_concurrent_launches(handlers, mocker):
+    await handlers.redis.flushall()
+    mocker.patch.object(Handlers, "send_msg")
+    mocker.patch("app.rockets.MAX_IN_FLIGHT", 2)
+
+    # The same rocket launched many times at once only flies once
+    rocket = await create_rocket(RocketBase(num_engines=4, height=200), "test")
+    results = await asyncio.gather(*(launch_rocket(rocket.id, "test") for _ in range(5)), return_exceptions=True)
+    assert sum(not isinstance(r, HTTPException) for r in results) == 1
+    assert all(r.status_code == 400 for r in results if isinstance(r, HTTPException))
+
+    # A burst of launches can't push the fleet over its budget
+    rockets = [await create_rocket(RocketBase(num_engines=4, height=200), "test") for _ in range(5)]
+    results = await asyncio.gather(*(launch_rocket(r.id, "test") for r in rockets), return_exceptions=True)
+    assert sum(not isinstance(r, HTTPException) for r in results) == 1
+    assert await handlers.redis.scard("in-flight") == 2
+
+
+@pytest.mark.asyncio
+async def test_relaunch_crashed_rocket(handlers, mocker):
+    await handlers.redis.flushall()
+    mocker.patch.object(Handlers, "send_msg")
+    mocker.patch("app.rockets.MAX_USER_IN_FLIGHT", 1)
+
+    rocket = await launch_rocket((await create_rocket(RocketBase(num_engines=4, height=200), "test")).id, "test")
+    await crash_rocket(rocket, "test", "Crash landed 🔥🚒")
+
+    with pytest.raises(HTTPException) as exc:
+        await launch_rocket(rocket.id, "test")
+    assert exc.value.status_code == 400
+    assert (await get_rocket(rocket.id, "test")).crashed
+
+    # The crashed rocket didn't take the user's only slot
+    other = await create_rocket(RocketBase(num_engines=4, height=200), "test")
+    assert (await launch_rocket(other.id, "test")).launched
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+        self.gone = asyncio.get_event_loop().create_future()
+
+    async def receive(self):
+        return await self.gone
+
+    async def send_text(self, msg):
+        self.sent.append(msg)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_stream_stops_on_disconnect(handlers, rocket, mocker):
+    mocker.patch("app.main.TIME_DELTA", 60)
+    await set_rocket(rocket, "test")
+    websocket = FakeWebSocket()
+
+    task = asyncio.create_task(stream_rocket(websocket, rocket.id))
+    for _ in range(100):
+        if websocket.sent:
+            break
+        await asyncio.sleep(0.01)
+    assert len(websocket.sent) == 1
+
+    # The stream ends as soon as the client goes, not at the next send
+    websocket.gone.set_result({"type": "websocket.disconnect"})
+    await asyncio.wait_for(task, 1)
+    assert not websocket.closed
@@ -0,0 +1,56 @@
+import asyncio
+import time
+import pytest
+
+from fastapi import HTTPException
+
+from app.main import profile
+from app.profiler import SamplingProfiler
+from app.security import get_admin_from_token
+
+
+async def blocker():
+    while True:
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)
+
+
+@pytest.mark.asyncio
+async def test_profiler_finds_blocking():
+    task = asyncio.create_task(blocker())
+    report = await SamplingProfiler(block_threshold=0.1).run(1)
+    task.cancel()
+
+    assert report["samples"] > 0
+    assert report["blocking"]
+    assert report["blocking"][0]["duration"] > 0.1
+    assert report["blocking"][0]["stack"].startswith("blocker;")
+
+    # Collapsed stacks: "root;...;leaf count"
+    stack, count = report["stacks"].splitlines()[0].rsplit(" ", 1)
+    assert ";" in stack
+    assert int(count) > 0
+
+
+@pytest.mark.asyncio
+async def test_profile_endpoint(mocker):
+    mocker.patch("app.security.ADMIN_USERS", ["admin"])
+    assert await get_admin_from_token("admin") == "admin"
+    with pytest.raises(HTTPException) as exc:
+        await get_admin_from_token("test")
+    assert exc.value.status_code == 403
+
+    with pytest.raises(HTTPException) as exc:
+        await profile(seconds=3600, username="admin")
+    assert exc.value.status_code == 400
+
+    SamplingProfiler.lock.acquire()
+    try:
+        with pytest.raises(HTTPException) as exc:
+            await profile(seconds=1, username="admin")
+        assert exc.value.status_code == 409
+    finally:
+        SamplingProfiler.lock.release()
+
+    report = await profile(seconds=0.2, username="admin")
+    assert report["samples"] > 0
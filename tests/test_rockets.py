@@ -1,14 +1,19 @@
+import json
+import time
 import pytest
 
 from hypothesis import given
 from hypothesis import strategies as st
 
-from app import MAX_ENGINES, MAX_HEIGHT, MIN_ENGINES, MIN_HEIGHT
-from app.models import RocketBase
+from app import MAX_ENGINES, MAX_HEIGHT, MIN_ENGINES, MIN_HEIGHT, TIME_DELTA
+import app.rockets
+from app.models import Rocket, RocketBase
 from app.handlers import Handlers
-from app.rockets import (calc_initial_fuel, calc_rocket_diameter,
-                         calc_rocket_mass, crash_rocket, generate_unique_id, get_key, get_rocket,
-                         set_rocket)
+from app.rockets import (FLIGHT_EVENTS, IN_FLIGHT, calc_flight_events, calc_flight_ticks, calc_initial_fuel,
+                         calc_rocket_diameter, calc_rocket_mass, calc_rocket_state, crash_rocket,
+                         find_rocket_owner, fleet_lagging, generate_unique_id, get_key, get_rocket,
+                         get_launches_key, handle_flight_event, has_landed, launch, rocket_id_exists, set_rocket, step_rocket,
+                         sweep_launches)
 
 
 @given(st.integers(MIN_ENGINES, MAX_ENGINES))
@@ -51,3 +56,141 @@ async def test_create_id(handlers):
     id1 = await generate_unique_id()
     id2 = await generate_unique_id()
     assert id1 != id2
+
+
+@pytest.mark.asyncio
+async def test_id_taken_by_other_user(rocket, handlers, mocker):
+    await set_rocket(rocket, "someone")
+    assert await rocket_id_exists(rocket.id)
+    assert not await rocket_id_exists("unused")
+
+    mocker.patch("app.rockets.get_random_word", side_effect=[rocket.id, "unused"])
+    assert await generate_unique_id() == "unused"
+
+
+def test_flight_ticks(rocket):
+    ticks = calc_flight_ticks(rocket)
+    assert ticks > 0
+
+    for _ in range(ticks - 1):
+        step_rocket(rocket)
+        assert not has_landed(rocket)
+    step_rocket(rocket)
+    assert has_landed(rocket)
+
+
+def test_lazy_state(rocket):
+    nofuel, crashed = calc_flight_events(rocket)
+    assert 0 < nofuel < crashed
+
+    rocket.launched = True
+    rocket.launched_at = 0.0
+    assert calc_rocket_state(rocket, 0.5 * TIME_DELTA) == rocket
+
+    flying = calc_rocket_state(rocket, (nofuel - 1) * TIME_DELTA)
+    assert flying.altitude > 0
+    assert flying.fuel > 0
+    assert not flying.crashed
+
+    landed = calc_rocket_state(rocket, crashed * TIME_DELTA)
+    assert landed.crashed
+    assert landed.altitude == 0
+    assert landed.max_altitude > 0
+
+    # The stored launch state is left untouched
+    assert rocket.altitude == 0
+
+
+@pytest.mark.asyncio
+async def test_lazy_launch(rocket, handlers, mocker):
+    mocker.patch("app.rockets.LAZY_FLIGHTS", True)
+    mocker.patch.object(Handlers, "send_msg")
+
+    await set_rocket(rocket, "test")
+    await launch(rocket, "test")
+    assert rocket.launched_at is not None
+    # Still announced on the exchange for other consumers
+    Handlers.send_msg.assert_called_once()
+    assert Handlers.send_msg.call_args[0][1] == f"rocket.{rocket.id}.launched"
+    assert await find_rocket_owner(rocket.id) == "test"
+
+    events = await handlers.redis.zrange(FLIGHT_EVENTS, 0, -1, withscores=True)
+    assert [json.loads(e)["event"] for e, _ in events] == ["nofuel", "crashed"]
+
+    # Pretend the flight started long enough ago to have landed
+    _, ticks = calc_flight_events(rocket)
+    rocket.launched_at = time.time() - ticks * TIME_DELTA
+    await set_rocket(rocket, "test")
+
+    assert (await get_rocket(rocket.id, "test")).crashed
+    assert not (await get_rocket(rocket.id, "test", evaluate=False)).crashed
+
+    await handle_flight_event({"event": "crashed", "id": rocket.id, "username": "test"})
+    assert (await get_rocket(rocket.id, "test", evaluate=False)).crashed
+
+
+@pytest.mark.asyncio
+async def test_tick_lag_budget(handlers, mocker):
+    mocker.patch("app.rockets.MAX_TICK_LAG", 2.0)
+    mocker.patch.object(handlers, "tick_lag", 0.5)
+    mocker.patch.object(handlers, "tick_lag_at", time.time())
+    assert not fleet_lagging()
+    handlers.tick_lag = 3.0
+    assert fleet_lagging()
+
+    # A slow tick still counts
+    handlers.tick_lag_at = time.time() - 3 * TIME_DELTA
+    assert fleet_lagging()
+
+    # Once the ticks stop the lag is stale and no longer blocks launches
+    mocker.patch("app.handlers.TICK_LAG_WINDOW", 5 * TIME_DELTA)
+    handlers.tick_lag_at = time.time() - 6 * TIME_DELTA
+    assert not fleet_lagging()
+
+
+@pytest.mark.asyncio
+async def test_sweep_launches(handlers, mocker):
+    mocker.patch.object(Handlers, "send_msg")
+    mocker.patch.object(handlers, "tick_lag_at", 0.0)
+    mocker.patch.dict(app.rockets.SWEEP_SEEN, clear=True)
+    rockets = {}
+    for name in ("gone", "crashed", "stuck", "flying", "lazy"):
+        rocket = Rocket(id=name, height=200, num_engines=4, fuel=100, launched=True)
+        await set_rocket(rocket, "test")
+        await handlers.redis.sadd(IN_FLIGHT, get_key(name, "test"))
+        await handlers.redis.sadd(get_launches_key("test"), name)
+        rockets[name] = rocket
+    await handlers.redis.delete(get_key("gone", "test"))
+    rockets["crashed"].crashed = True
+    await set_rocket(rockets["crashed"], "test")
+    rockets["lazy"].launched_at = time.time() - calc_flight_ticks(rockets["lazy"]) * TIME_DELTA - 3600
+    await set_rocket(rockets["lazy"], "test")
+
+    assert await sweep_launches() == 3
+    assert await handlers.redis.smembers(IN_FLIGHT) == {get_key("stuck", "test"), get_key("flying", "test")}
+    assert (await get_rocket("lazy", "test", evaluate=False)).crashed
+
+    # Only the flight that ticked since the last sweep keeps its slot
+    step_rocket(rockets["flying"])
+    await set_rocket(rockets["flying"], "test")
+    assert await sweep_launches() == 1
+    assert await handlers.redis.smembers(IN_FLIGHT) == {get_key("flying", "test")}
+    assert await handlers.redis.smembers(get_launches_key("test")) == {"flying"}
+
+
+def test_lazy_state_checkpoint(rocket, mocker):
+    rocket.launched = True
+    rocket.launched_at = 0.0
+    expected = calc_rocket_state(rocket.copy(update={"id": "fresh"}), 20 * TIME_DELTA)
+
+    spy = mocker.spy(app.rockets, "step_rocket")
+    calc_rocket_state(rocket, 10 * TIME_DELTA)
+    assert spy.call_count == 10
+
+    # The next read carries on from the previous one
+    state = calc_rocket_state(rocket, 20 * TIME_DELTA)
+    assert spy.call_count == 20
+    assert state.altitude == expected.altitude
+
+    # Reading an earlier time replays from launch
+    assert calc_rocket_state(rocket, 5 * TIME_DELTA).altitude < state.altitude